@@ -1,19 +1,177 @@
 import os
 import json
-import re
+import tempfile
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from playwright.sync_api import sync_playwright
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 URL = "https://outages.topenergy.co.nz"
 FRAME_DIR = "frames"
 HISTORY_DIR = "data/history"
+DETAIL_CACHE = "data/detail_cache.json"
+DETAIL_WORKERS = 8
+CAPTURE_INTERVAL_SECONDS = 15 * 60
+BROWSER_RECYCLE_SECONDS = 6 * 60 * 60
 
-def main():
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
+# Per-outage fields copied into the slim sidecar; keep in sync with
+# OUTAGE_FIELDS in process_data.py, which is the only reader.
+SLIM_OUTAGE_FIELDS = ("name", "circuitName", "customersCurrentlyOff", "type")
+
+# Directories this process has already created, so repeat captures skip the syscall
+_created_dirs = set()
+
+def ensure_dir(path):
+    """Creates a directory (and parents) the first time it is asked for."""
+    if path not in _created_dirs:
+        os.makedirs(path, exist_ok=True)
+        _created_dirs.add(path)
+
+def create_session():
+    """Returns a keep-alive session so every detail request reuses one TLS connection."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=16,
+                          max_retries=Retry(total=3, backoff_factor=0.3))
+    session.mount("https://", adapter)
+    return session
+
+def load_detail_cache():
+    """Returns the outage_id -> {etag, payload} map saved by the previous capture."""
+    try:
+        with open(DETAIL_CACHE, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def dump_json_atomically(path, data, **kwargs):
+    """Writes JSON via a temp file so an interrupted run can't leave a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f, **kwargs)
+    os.replace(tmp_path, path)
+
+def save_detail_cache(cache):
+    """Rewrites the detail cache atomically."""
+    dump_json_atomically(DETAIL_CACHE, cache)
+
+def fetch_outage_detail(session, outage_id, cached):
+    """
+    Fetches one outage's detail payload, revalidating any cached copy by ETag.
+    Returns a cache entry: {"etag": ..., "payload": ...}.
+    """
+    headers = {"If-None-Match": cached["etag"]} if cached else {}
+    response = session.get(f"{URL}/api/outage/{outage_id}/info", headers=headers, timeout=10)
+    if cached and response.status_code == 304:
+        return cached
+    response.raise_for_status()
+    return {"etag": response.headers.get("ETag"), "payload": response.json()}
+
+def fetch_outage_details(session, outage_ids, cache):
+    """
+    Fetches the detail payload for each outage concurrently.
+    A failed request only drops that outage; the results keep the page's order.
+    Returns the cache entries for the outages that could be fetched.
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=DETAIL_WORKERS) as executor:
+        futures = {
+            executor.submit(fetch_outage_detail, session, outage_id, cache.get(outage_id)): outage_id
+            for outage_id in outage_ids
+        }
+        for future in as_completed(futures):
+            outage_id = futures[future]
+            try:
+                entry = future.result()
+                if entry is cache.get(outage_id):
+                    print(f"  - Details unchanged for {outage_id}")
+                else:
+                    print(f"  - Successfully fetched details for {outage_id}")
+                results[outage_id] = entry
+            except requests.exceptions.RequestException as e:
+                print(f"  - Warning: Could not fetch details for {outage_id}. Error: {e}")
+
+    return {outage_id: results[outage_id] for outage_id in outage_ids if outage_id in results}
+
+def build_slim_record(json_ts, data, detailed_outage_info):
+    """
+    Projects a capture down to what process_data.py reads, so it can skip
+    parsing the full rawFrontendInitData (markers, backend state, ...).
+    """
+    active = []
+    details = {}
+    for outage in data.get("outageList", {}).get("active", []):
+        outage_id = outage.get("name")
+        if not outage_id:
+            continue
+        active.append({field: outage[field] for field in SLIM_OUTAGE_FIELDS if field in outage})
+        if outage_id in detailed_outage_info:
+            details[outage_id] = detailed_outage_info[outage_id]
+
+    return {"timestamp": json_ts, "active": active, "detailedOutageInfo": details}
+
+class Capturer:
+    """
+    Owns the Playwright browser, its context and the HTTP session, so a
+    long-running process can capture repeatedly without paying Chromium's
+    cold start each time. The browser is relaunched every `recycle_after`
+    seconds to keep slow memory leaks bounded.
+    """
+
+    def __init__(self, recycle_after=BROWSER_RECYCLE_SECONDS):
+        self.recycle_after = recycle_after
+        self.playwright = None
+        self.browser = None
+        self.context = None
+        self.session = None
+        self.launched_at = 0.0
+
+    def __enter__(self):
+        self.playwright = sync_playwright().start()
+        try:
+            self._launch_browser()
+        except Exception:
+            self.playwright.stop()
+            raise
+        self.session = create_session()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.session.close()
+        if self.browser:
+            self.browser.close()
+        self.playwright.stop()
+
+    def _launch_browser(self):
+        self.browser = self.playwright.chromium.launch(headless=True)
+        self.context = self.browser.new_context()
+        self.launched_at = time.monotonic()
+
+    def _recycle_browser_if_due(self):
+        if time.monotonic() - self.launched_at >= self.recycle_after:
+            print("Recycling browser...")
+            if self.browser:
+                try:
+                    self.browser.close()
+                except Exception as e:
+                    print(f"Warning: Could not close the old browser. Error: {e}")
+                self.browser = None
+            self._launch_browser()
+
+    def capture(self):
+        """
+        Saves one history snapshot and map screenshot. Errors are reported
+        rather than raised, so a --loop process survives them; if the
+        browser itself failed, it is relaunched on the next capture.
+        """
+        page = None
         try:
-            page = browser.new_page()
+            self._recycle_browser_if_due()
+            page = self.context.new_page()
+
             print(f"Loading {URL}...")
             page.goto(URL, wait_until="networkidle")
 
@@ -35,25 +193,19 @@ def main():
             # Define monthly subdirectories
             monthly_frame_dir = os.path.join(FRAME_DIR, year_month)
             monthly_history_dir = os.path.join(HISTORY_DIR, year_month)
-            os.makedirs(monthly_frame_dir, exist_ok=True)
-            os.makedirs(monthly_history_dir, exist_ok=True)
+            ensure_dir(monthly_frame_dir)
+            ensure_dir(monthly_history_dir)
 
             # --- NEW: Fetch detailed data for active outages ---
             detailed_outage_info = {}
             active_outages = data.get("outageList", {}).get("active", [])
             if active_outages:
                 print(f"Found {len(active_outages)} active outage(s). Fetching details...")
-                for outage in active_outages:
-                    outage_id = outage.get("name")
-                    if outage_id:
-                        try:
-                            detail_url = f"{URL}/api/outage/{outage_id}/info"
-                            response = requests.get(detail_url, timeout=10)
-                            response.raise_for_status()
-                            detailed_outage_info[outage_id] = response.json()
-                            print(f"  - Successfully fetched details for {outage_id}")
-                        except requests.exceptions.RequestException as e:
-                            print(f"  - Warning: Could not fetch details for {outage_id}. Error: {e}")
+                outage_ids = [outage.get("name") for outage in active_outages if outage.get("name")]
+                entries = fetch_outage_details(self.session, outage_ids, load_detail_cache())
+                detailed_outage_info = {outage_id: entry["payload"] for outage_id, entry in entries.items()}
+                # Only currently active outages are kept, so the cache never grows unbounded
+                save_detail_cache({outage_id: entry for outage_id, entry in entries.items() if entry["etag"]})
 
             # Save full JSON with timestamp
             # Create two separate timestamp formats
@@ -61,14 +213,17 @@ def main():
             json_ts = now.strftime("%Y-%m-%dT%H:%M:%SZ")     # For valid ISO 8601 timestamps
 
             json_filename = os.path.join(monthly_history_dir, f"{filename_ts}.json")
-            with open(json_filename, "w") as f:
-                json.dump({
-                    "timestamp": json_ts, # Use the correct format inside the JSON
-                    "rawFrontendInitData": data,
-                    "detailedOutageInfo": detailed_outage_info # Embed the new detailed data
-                }, f, indent=2)
+            dump_json_atomically(json_filename, {
+                "timestamp": json_ts, # Use the correct format inside the JSON
+                "rawFrontendInitData": data,
+                "detailedOutageInfo": detailed_outage_info # Embed the new detailed data
+            }, indent=2)
             print(f"Saved data to {json_filename}")
 
+            # process_data.py trusts a sidecar that parses, so it must never be partial
+            slim_filename = os.path.join(monthly_history_dir, f"{filename_ts}.slim.json")
+            dump_json_atomically(slim_filename, build_slim_record(json_ts, data, detailed_outage_info))
+
             # Screenshot just the map
             print("Taking screenshot...")
             map_element = page.locator("#map").first
@@ -80,8 +235,28 @@ def main():
 
         except Exception as e:
             print(f"An error occurred: {e}")
+            if page is None:
+                self.launched_at = float("-inf")
         finally:
-            browser.close()
+            if page is not None:
+                try:
+                    page.close()
+                except Exception as e:
+                    print(f"Warning: Could not close the page. Error: {e}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Capture Top Energy outage data and a map screenshot.")
+    parser.add_argument("--loop", action="store_true",
+                        help="keep the browser running and capture every --interval seconds")
+    parser.add_argument("--interval", type=int, default=CAPTURE_INTERVAL_SECONDS,
+                        help="seconds between captures in --loop mode (default: %(default)s)")
+    args = parser.parse_args()
+
+    with Capturer() as capturer:
+        capturer.capture()
+        while args.loop:
+            time.sleep(args.interval)
+            capturer.capture()
 
 if __name__ == "__main__":
-    main()
+    main()
\ No newline at end of file
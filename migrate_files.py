@@ -1,9 +1,16 @@
 import os
-import re
-import shutil
 
 BASE_DIRS = ["frames", "data/history"]
-FILENAME_PATTERN = re.compile(r"(\d{4}-\d{2})-\d{2}T.*")
+
+def get_year_month(filename):
+    """
+    Returns the YYYY-MM prefix of a 'YYYY-MM-DDT...' filename, or None.
+    The prefix has a fixed shape, so index checks replace a regex match.
+    """
+    if (len(filename) > 10 and filename[4] == "-" and filename[7] == "-" and filename[10] == "T"
+            and filename[:4].isdecimal() and filename[5:7].isdecimal() and filename[8:10].isdecimal()):
+        return filename[:7]
+    return None
 
 def migrate_files():
     """
@@ -18,23 +25,29 @@ def migrate_files():
 
         print(f"\nScanning '{base_dir}' for files to migrate...")
         migrated_count = 0
-        
-        for item_name in os.listdir(base_dir):
-            item_path = os.path.join(base_dir, item_name)
-            
-            # We only care about files at the root, not items already in subdirectories
-            if os.path.isfile(item_path):
-                match = FILENAME_PATTERN.match(item_name)
-                if match:
-                    year_month = match.group(1) # e.g., "2025-11"
-                    target_dir = os.path.join(base_dir, year_month)
-                    os.makedirs(target_dir, exist_ok=True)
-                    destination_path = os.path.join(target_dir, item_name)
-                    
-                    print(f"  - Moving '{item_path}' to '{destination_path}'")
-                    shutil.move(item_path, destination_path)
-                    migrated_count += 1
-        
+
+        # Group the files by month first so each target directory is created once
+        files_by_month = {}
+        with os.scandir(base_dir) as entries:
+            for entry in entries:
+                # We only care about files at the root, not items already in subdirectories
+                if entry.is_file(follow_symlinks=False):
+                    year_month = get_year_month(entry.name) # e.g., "2025-11"
+                    if year_month:
+                        files_by_month.setdefault(year_month, []).append(entry.name)
+
+        for year_month, item_names in files_by_month.items():
+            target_dir = os.path.join(base_dir, year_month)
+            os.makedirs(target_dir, exist_ok=True)
+            for item_name in item_names:
+                item_path = os.path.join(base_dir, item_name)
+                destination_path = os.path.join(target_dir, item_name)
+
+                # Source and destination share base_dir, so a plain rename always works
+                print(f"  - Moving '{item_path}' to '{destination_path}'")
+                os.replace(item_path, destination_path)
+                migrated_count += 1
+
         print(f"Migrated {migrated_count} files in '{base_dir}'.")
 
     print("\n--- Migration complete ---")
@@ -1,53 +1,241 @@
 import os
-import glob
-import json
-import shutil
-import requests
+import io
+import hashlib
+import pickle
+import bisect
+import heapq
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from operator import itemgetter
+import orjson
+import zstandard
 
 DATA_DIR = "data/history"
 PUBLIC_DIR = "public"
 OUTAGES_JSON = os.path.join(PUBLIC_DIR, "outages.json")
+# Events are published in one file per start month (YYYY-MM.json) so a run
+# only rewrites the months whose events actually changed.
+EVENTS_DIR = os.path.join(PUBLIC_DIR, "events")
 
-def get_last_processed_file():
-    """Reads the state file and returns the last processed filename."""
+# The only per-outage fields process_files reads from outageList.active
+OUTAGE_FIELDS = ("name", "circuitName", "customersCurrentlyOff", "type")
+
+# capture.py writes this pre-projected sidecar next to each full history file
+SLIM_SUFFIX = ".slim.json"
+
+# Projections of full captures that have no sidecar, pickled per file and
+# refreshed when the capture is newer than its cache entry. Local only.
+CACHE_DIR = "data/.cache"
+
+# Closed months are packed into data/history/YYYY-MM.jsonl.zst, one
+# {"file": ..., "data": ...} capture per line, sorted by filename.
+ARCHIVE_SUFFIX = ".jsonl.zst"
+# Next to each archive, the names of the captures in it, one per line, so
+# listing a month does not have to decompress and parse the archive
+ARCHIVE_INDEX_SUFFIX = ".names.txt"
+
+# Below this many files the process pool costs more to start than it saves
+PARALLEL_PARSE_MIN_FILES = 256
+PARSE_CHUNKSIZE = 32
+
+ORJSON_OPTS = orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE
+
+@dataclass
+class State:
+    """Everything a run carries over from, and hands on to, the next run."""
+    last_processed_file: str = None
+    events: dict = field(default_factory=dict) # Keyed by outage ID
+    dirty_ids: set = field(default_factory=set) # Events whose shard must be rewritten
+
+def load_state():
+    """Reads the state file and its event shards; returns an empty State if there is none."""
     if not os.path.exists(OUTAGES_JSON):
         print("State file not found. Will process all history.")
-        return None, {} # Return no file and no existing data
+        return State()
 
     try:
-        with open(OUTAGES_JSON, "r") as f:
-            data = json.load(f)
+        data = load_json(OUTAGES_JSON)
         # The state data is now the top-level object
         last_file = data.get("lastProcessedFile")
-        if last_file and "events" in data:
+        if last_file and "shards" in data:
             # Return the full path for accurate comparison
             print(f"Last processed file was: {os.path.basename(last_file)}")
             # Convert list of events back to a dictionary keyed by ID for processing
+            events_dict = {event['id']: event for event in load_event_shards(data['shards'])}
+            return State(last_file, events_dict)
+        elif last_file and "events" in data:
+            # Older single-file state: every event still has to be written to a shard
+            print(f"Last processed file was: {os.path.basename(last_file)}")
             events_dict = {event['id']: event for event in data['events']}
-            return last_file, {"events": events_dict}
+            return State(last_file, events_dict, set(events_dict))
         else:
             print("No marker found in state file. Will process all history.")
-            return None, {}
-    except (json.JSONDecodeError, FileNotFoundError):
+            return State()
+    except (orjson.JSONDecodeError, FileNotFoundError):
         print("Could not read or parse state file. Will process all history.")
-        return None, {}
+        return State()
+
+def write_state(state):
+    """Writes the changed event shards, then the state file that lists them."""
+    write_event_shards(state.events, state.dirty_ids)
+    write_json(OUTAGES_JSON, {
+        "lastProcessedFile": state.last_processed_file,
+        "shards": sorted({shard_key(event) for event in state.events.values()})
+    })
+
+def load_json(path):
+    """
+    Parses a JSON file straight from its bytes. The file is read unbuffered
+    in one call, skipping BufferedReader's extra copy of every file.
+    """
+    with open(path, "rb", buffering=0) as f:
+        return orjson.loads(f.readall())
+
+def write_json(path, data):
+    """
+    Serializes data in memory, writes it with a single large write and
+    atomically swaps it into place, so a crash never leaves a partial file.
+    """
+    payload = orjson.dumps(data, option=ORJSON_OPTS)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb", buffering=1 << 20) as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def shard_key(event):
+    """Returns the YYYY-MM shard an event is published in, based on its start."""
+    return event["start"][:7]
+
+def load_event_shards(shards):
+    """Reads the events from every published shard, oldest month first."""
+    events = []
+    for shard in shards:
+        events.extend(load_json(os.path.join(EVENTS_DIR, f"{shard}.json"))["events"])
+    return events
+
+def write_event_shards(events, dirty_ids):
+    """Rewrites only the shards containing an event that changed during this run."""
+    dirty_shards = {shard_key(events[outage_id]) for outage_id in dirty_ids}
+    if not dirty_shards:
+        return
+
+    shard_events = {shard: [] for shard in dirty_shards}
+    for event in events.values():
+        shard = shard_key(event)
+        if shard in shard_events:
+            shard_events[shard].append(event)
+
+    os.makedirs(EVENTS_DIR, exist_ok=True)
+    for shard, shard_list in sorted(shard_events.items()):
+        write_json(os.path.join(EVENTS_DIR, f"{shard}.json"), {"events": shard_list})
+        print(f"  - Wrote {len(shard_list)} events to shard {shard}")
+
+def archive_path(month):
+    """Returns the path of a month's packed history archive."""
+    return os.path.join(DATA_DIR, f"{month}{ARCHIVE_SUFFIX}")
+
+def iter_archive(month):
+    """Yields (filename, capture) for every capture in a month archive, in filename order."""
+    with open(archive_path(month), "rb") as f:
+        reader = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f))
+        for line in reader:
+            entry = orjson.loads(line)
+            yield entry["file"], entry["data"]
+
+def archive_index_path(month):
+    """Returns the path of the capture name index of a month archive."""
+    return os.path.join(DATA_DIR, f"{month}{ARCHIVE_INDEX_SUFFIX}")
+
+def write_archive_index(month, names):
+    """Writes the capture names of a month archive, one per line."""
+    tmp_path = archive_index_path(month) + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("".join(f"{name}\n" for name in names))
+    os.replace(tmp_path, archive_index_path(month))
+
+def read_archive_names(month):
+    """
+    Returns the capture names in a month archive from its index. An archive
+    packed before indexes were written is read in full once to create one.
+    """
+    try:
+        with open(archive_index_path(month)) as f:
+            return f.read().split()
+    except FileNotFoundError:
+        names = [name for name, _ in iter_archive(month)]
+        write_archive_index(month, names)
+        return names
+
+def list_loose_files(month_dir):
+    """Returns the sorted names of the full capture files in a month directory."""
+    with os.scandir(month_dir) as entries:
+        return sorted(
+            entry.name for entry in entries
+            if entry.name.endswith(".json") and not entry.name.endswith(SLIM_SUFFIX)
+        )
+
+def history_path(month, name):
+    """
+    Returns the path of a history file, always with forward slashes so it
+    can be stored as lastProcessedFile and used as a cache key as-is.
+    """
+    return f"{DATA_DIR}/{month}/{name}"
+
+def list_history_files(month, after=""):
+    """
+    Returns the sorted paths of the history files captured in one YYYY-MM
+    month, skipping every file whose name sorts at or before `after`.
+    Captures packed into the month's archive are listed under the path
+    they had before packing, so lastProcessedFile stays comparable.
+    """
+    month_dir = os.path.join(DATA_DIR, month)
+    names = set(list_loose_files(month_dir)) if os.path.isdir(month_dir) else set()
+    if os.path.exists(archive_path(month)):
+        names.update(read_archive_names(month))
+    names = sorted(names)
+    start = bisect.bisect_right(names, after) if after else 0
+    return [history_path(month, name) for name in names[start:]]
 
 def find_new_files(last_processed_file):
-    """Finds all data files newer than the last processed one."""
-    all_files = sorted(glob.glob(os.path.join(DATA_DIR, "**", "*.json"), recursive=True))
-    
-    if not last_processed_file:
-        return all_files
+    """
+    Finds all data files newer than the last processed one.
+    Files are sharded into YYYY-MM directories and their names sort
+    chronologically, so only the months from the last processed one onward
+    need to be listed. Captures still at the top level of DATA_DIR (before
+    migration) are merged in by name.
+    """
+    if not os.path.isdir(DATA_DIR):
+        return []
+
+    with os.scandir(DATA_DIR) as entries:
+        months = sorted({
+            entry.name[:-len(ARCHIVE_SUFFIX)] if entry.name.endswith(ARCHIVE_SUFFIX) else entry.name
+            for entry in entries
+            if entry.is_dir() or entry.name.endswith(ARCHIVE_SUFFIX)
+        })
+    top_level = list_loose_files(DATA_DIR)
 
-    # Find the index of the last processed file and return the slice of files after it
-    # This is efficient because the list is sorted chronologically by filename
-    for i, f in enumerate(all_files):
-        if f.replace("\\", "/") == last_processed_file.replace("\\", "/"):
-            return all_files[i+1:]
+    # The last file may have been migrated or packed since, so look for it
+    # by name wherever its month can be
+    last_name = os.path.basename(last_processed_file) if last_processed_file else ""
+    last_month = last_name[:7]
+    if last_name and not (
+        os.path.exists(os.path.join(DATA_DIR, last_name))
+        or os.path.exists(os.path.join(DATA_DIR, last_month, last_name))
+        or os.path.exists(archive_path(last_month))
+    ):
+        # If the last processed file was not found (maybe deleted?), re-process everything
+        print("Warning: Last processed file not found in history. Re-processing all files.")
+        last_name = last_month = ""
 
-    # If the last processed file was not found (maybe deleted?), re-process everything
-    print("Warning: Last processed file not found in history. Re-processing all files.")
-    return all_files
+    new_files = [f for month in months if month >= last_month for f in list_history_files(month, after=last_name)]
+    start = bisect.bisect_right(top_level, last_name)
+    new_files.extend(f"{DATA_DIR}/{name}" for name in top_level[start:])
+    return sorted(new_files, key=os.path.basename)
 
 def format_full_history_body(event):
     """Creates the final, comprehensive body text from the detail history."""
@@ -83,61 +271,216 @@ def format_full_history_body(event):
 
     return "\n".join(body_parts)
 
-def process_files(new_files, existing_data):
+def read_history_file(file_path):
+    """
+    Loads a history file and keeps only the fields process_files needs.
+    Returns (timestamp, active_outages, details) so the rest of the capture
+    (map markers, backend state, etc.) can be freed straight away.
+    Prefers the slim sidecar, which already holds exactly that projection;
+    older captures without one, or with one cut short, fall back to the
+    full file.
+    """
+    try:
+        slim = load_json(file_path[:-len(".json")] + SLIM_SUFFIX)
+        return slim["timestamp"], slim["active"], slim["detailedOutageInfo"]
+    except FileNotFoundError:
+        pass
+    except orjson.JSONDecodeError:
+        print(f"Warning: Unreadable sidecar for {file_path}, reading the full capture instead.")
+
+    return read_cached_capture(file_path)
+
+def cache_path(file_path):
+    """Returns the CACHE_DIR entry for a history file."""
+    key = hashlib.sha1(file_path.encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.pkl")
+
+def read_cached_capture(file_path):
+    """Projects a full capture, reusing its pickled projection while that is fresh."""
+    cached = cache_path(file_path)
+    try:
+        if os.path.getmtime(cached) >= os.path.getmtime(file_path):
+            with open(cached, "rb") as f:
+                return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    projected = project_capture(load_json(file_path))
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Pool workers may cache concurrently; the pid keeps their temp files apart
+    tmp_path = f"{cached}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(projected, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cached)
+    return projected
+
+def project_capture(data):
+    """Reduces a full capture to (timestamp, active_outages, details)."""
+    detailed_info = data.get("detailedOutageInfo") or {}
+    active_outages = []
+    details = {}
+    for outage in data.get("rawFrontendInitData", {}).get("outageList", {}).get("active", []):
+        outage_id = outage.get("name")
+        if not outage_id:
+            continue
+        active_outages.append({field: outage[field] for field in OUTAGE_FIELDS if field in outage})
+        if outage_id in detailed_info:
+            details[outage_id] = detailed_info[outage_id]
+
+    return data.get("timestamp", ""), active_outages, details
+
+def read_archived_month(month, month_files):
+    """
+    Streams the requested captures out of a month archive, falling back to
+    loose files for any capture that arrived after the month was packed.
+    """
+    captures = iter_archive(month)
+    name, capture = next(captures, (None, None))
+    for file_path in month_files:
+        wanted = os.path.basename(file_path)
+        while name is not None and name < wanted:
+            name, capture = next(captures, (None, None))
+        if name == wanted:
+            yield project_capture(capture)
+        else:
+            yield read_history_file(file_path)
+
+def read_history_files(new_files):
+    """
+    Yields read_history_file() results for each file, in order.
+    Archived months are streamed from their .jsonl.zst file. Large backlogs
+    of loose files are parsed across all cores; only the event state machine
+    in process_files has to run sequentially.
+    """
+    executor = ProcessPoolExecutor() if len(new_files) >= PARALLEL_PARSE_MIN_FILES else None
+    try:
+        for month, month_files in itertools.groupby(new_files, key=lambda f: os.path.basename(os.path.dirname(f))):
+            month_files = list(month_files)
+            if os.path.exists(archive_path(month)):
+                yield from read_archived_month(month, month_files)
+            elif executor:
+                yield from executor.map(read_history_file, month_files, chunksize=PARSE_CHUNKSIZE)
+            else:
+                yield from map(read_history_file, month_files)
+    finally:
+        if executor:
+            executor.shutdown()
+
+def roll_over_closed_months(last_processed_file):
+    """
+    Packs the loose captures of every month that is both over and fully
+    processed into its YYYY-MM.jsonl.zst archive, then deletes them.
+    Captures already in an existing archive are kept and merged in order.
+    """
+    last_month = os.path.basename(last_processed_file)[:7]
+    cutoff = min(datetime.utcnow().strftime("%Y-%m"), last_month)
+    with os.scandir(DATA_DIR) as entries:
+        months = sorted(entry.name for entry in entries if entry.is_dir() and entry.name < cutoff)
+
+    for month in months:
+        month_dir = os.path.join(DATA_DIR, month)
+        loose_names = list_loose_files(month_dir)
+        if not loose_names:
+            continue
+
+        archive = archive_path(month)
+        archived = iter_archive(month) if os.path.exists(archive) else iter(())
+        loose = ((name, None) for name in loose_names)
+
+        tmp_path = archive + ".tmp"
+        packed_names = []
+        with open(tmp_path, "wb") as f:
+            with zstandard.ZstdCompressor().stream_writer(f, closefd=False) as writer:
+                for name, data in heapq.merge(archived, loose, key=itemgetter(0)):
+                    if packed_names and name == packed_names[-1]:
+                        continue
+                    if data is None:
+                        data = load_json(os.path.join(month_dir, name))
+                    writer.write(orjson.dumps({"file": name, "data": data}, option=orjson.OPT_APPEND_NEWLINE))
+                    packed_names.append(name)
+        os.replace(tmp_path, archive)
+        # The loose files are still there until the index is written, so a
+        # stale index never hides a capture
+        write_archive_index(month, packed_names)
+
+        for name in loose_names:
+            os.remove(os.path.join(month_dir, name))
+            slim_path = os.path.join(month_dir, name[:-len(".json")] + SLIM_SUFFIX)
+            if os.path.exists(slim_path):
+                os.remove(slim_path)
+            cached = cache_path(history_path(month, name))
+            if os.path.exists(cached):
+                os.remove(cached)
+        if not os.listdir(month_dir):
+            os.rmdir(month_dir)
+        print(f"Packed {len(loose_names)} captures from {month} into {archive}")
+
+def process_files(new_files, state):
     """
     Processes new data files to identify and update outage events.
-    Returns a dictionary of all events.
+    Updates state in place: its events, the IDs that changed, and the last
+    processed file.
     """
-    events = existing_data.get("events", {})
+    events = state.events
+    dirty_ids = state.dirty_ids
     
+    # Events still waiting for an end time. Only these can finish, so the
+    # finished-outage check never has to look at closed historical events.
+    open_events = {outage_id: event for outage_id, event in events.items() if event["end"] is None}
+
     # Track which outage IDs were active in the previous file processed
-    # This helps us determine when an outage has ended.
-    previously_active_ids = set(events.keys())
+    # This helps us determine when an outage has ended. The two dicts are
+    # reused for every file (cleared and swapped) rather than reallocated.
+    previously_active_ids = dict.fromkeys(open_events)
+    current_active_ids = {}
+
+    for timestamp_str, active_outages, detailed_info in read_history_files(new_files):
 
-    for file_path in new_files:
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-        
         # Get the timestamp and ensure it's in the correct ISO 8601 format
         # This handles historical data that used hyphens in the time part.
-        timestamp_str = data.get("timestamp", "")
-        # A valid timestamp like "2025-11-22T10:00:00Z" will be unaffected.
+        # A valid timestamp like "2025-11-22T10:00:00Z" is used as-is.
         # An invalid one like "2025-11-22T10-00-00Z" will be corrected.
-        timestamp = timestamp_str[:10] + timestamp_str[10:].replace('-', ':')
-        outage_list = data.get("rawFrontendInitData", {}).get("outageList", {})
-        active_outages = outage_list.get("active", [])
-        
-        current_active_ids = {outage['name'] for outage in active_outages}
+        if timestamp_str.find('-', 10) != -1:
+            timestamp = timestamp_str[:10] + timestamp_str[10:].replace('-', ':')
+        else:
+            timestamp = timestamp_str
+
+        current_active_ids.clear()
+        get_details = detailed_info.get
 
         # Find newly started outages
         for outage in active_outages:
-            outage_id = outage.get("name")
-            if not outage_id:
-                continue
+            outage_id = outage["name"]
+            current_active_ids[outage_id] = None
 
             # Always get the latest available details for the outage
-            details = data.get("detailedOutageInfo", {}).get(outage_id)
+            details = get_details(outage_id)
 
-            if outage_id not in events:
+            event = events.get(outage_id)
+            if event is None:
                 print(f"  - New outage started: {outage_id} at {timestamp}")
-                
-                events[outage_id] = {
+
+                # Only new outages need their summary fields, so read them here, once
+                customers = outage.get("customersCurrentlyOff")
+                event = events[outage_id] = {
                     "id": outage_id,
-                    "title": f"{outage.get('circuitName', 'Unknown')} ({outage.get('customersCurrentlyOff')} customers)",
+                    "title": f"{outage.get('circuitName', 'Unknown')} ({customers} customers)",
                     "start": timestamp,
                     "end": None, # End time is unknown for now
                     "allDay": False, # Keep original field name for now
                     "extendedProps": { # Keep original field name for now
                         "type": outage.get("type"),
-                        "customers": outage.get("customersCurrentlyOff"),
+                        "customers": customers,
                         "circuit": outage.get("circuitName"),
                         "detail_history": [] # Initialize the history list
                     }
                 }
+                open_events[outage_id] = event
+                dirty_ids.add(outage_id)
             
             # --- New Logic: Append details to history if they are new ---
             if details:
-                history = events[outage_id]["extendedProps"].get("detail_history", [])
+                history = event["extendedProps"].get("detail_history", [])
                 last_known_details = history[-1].get("details") if history else None
 
                 if details != last_known_details:
@@ -146,25 +489,29 @@ def process_files(new_files, existing_data):
                         "capture_ts": timestamp,
                         "details": details
                     })
-                    events[outage_id]["extendedProps"]["detail_history"] = history
+                    event["extendedProps"]["detail_history"] = history
+                    dirty_ids.add(outage_id)
 
         # Find finished outages (were active before, but are not now)
-        finished_outages = previously_active_ids - current_active_ids
-        for outage_id in finished_outages:
-            if outage_id in events and events[outage_id]["end"] is None:
+        for outage_id in previously_active_ids:
+            if outage_id in current_active_ids:
+                continue
+            event = open_events.pop(outage_id, None)
+            if event is not None:
                 print(f"  - Outage finished: {outage_id} at {timestamp}")
-                events[outage_id]["end"] = timestamp
+                event["end"] = timestamp
+                dirty_ids.add(outage_id)
 
-        previously_active_ids = current_active_ids
+        previously_active_ids, current_active_ids = current_active_ids, previously_active_ids
 
-    return events
+    state.last_processed_file = new_files[-1]
 
 def main():
     print("\n--- Starting data processing ---")
     os.makedirs(PUBLIC_DIR, exist_ok=True)
 
-    last_processed_file, existing_data = get_last_processed_file()
-    new_files = find_new_files(last_processed_file)
+    state = load_state()
+    new_files = find_new_files(state.last_processed_file)
 
     if not new_files:
         print("No new data files to process. Exiting.")
@@ -172,22 +519,20 @@ def main():
 
     print(f"Found {len(new_files)} new data files to process.")
 
-    events = process_files(new_files, existing_data)
+    process_files(new_files, state)
 
     # --- New Step: Generate the final body text from the history for each event ---
-    for event in events.values():
-        event["extendedProps"]["body"] = format_full_history_body(event)
-
-    # Prepare the final JSON structure
-    output_data = {
-        "lastProcessedFile": new_files[-1].replace("\\", "/"),
-        "events": list(events.values())
-    }
-
-    with open(OUTAGES_JSON, "w") as f:
-        json.dump(output_data, f, indent=2)
+    # Only events changed this run need it; the rest keep the body they were
+    # loaded with.
+    for outage_id, event in state.events.items():
+        extended_props = event["extendedProps"]
+        if outage_id in state.dirty_ids or "body" not in extended_props:
+            extended_props["body"] = format_full_history_body(event)
 
+    write_state(state)
     print(f"\nSuccessfully processed data and created {OUTAGES_JSON}")
 
+    roll_over_closed_months(state.last_processed_file)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
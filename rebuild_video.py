@@ -1,18 +1,537 @@
 import os
-import glob
+import io
 import shutil
 import subprocess
 import json
+import struct
+import collections
+import itertools
+from dataclasses import dataclass
 
 FRAME_DIR = "frames"
 TEMP_DIR = "temp_frames"
 CHUNK_FILENAME = "daily_chunk.mp4"
 MASTER_FILENAME = "outages.mp4"
 STATE_FILE = "public/outages.json"
+FONT_FILE = "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf"
+# Each frame is shown for 1/8 s; the stamp commands are keyed to the same grid
+FRAME_DURATION = 0.125
+STAMP_COMMANDS = "stamp_commands.txt"
+# Lines of ffmpeg's stderr kept for error reports; progress output is dropped
+STDERR_TAIL_LINES = 200
+
+# Frames are linked into TEMP_DIR as a numbered sequence for the image2 demuxer
+FRAME_PATTERN = "f_%06d.png"
+
+# Chunk encoder settings. The master's avcC keeps the SPS/PPS of its first
+# chunk; a chunk encoded against different ones (another preset or frame
+# size) gets its own written in-band before each keyframe when appended.
+# Keeping the settings fixed keeps the append a plain copy.
+X264_ARGS = ["-c:v", "libx264", "-crf", "28", "-tune", "stillimage"]
+
+# The master and each chunk are fragmented MP4s, so a day's chunk can be
+# appended by copying its fragments instead of remuxing the whole master
+FRAGMENT_MOVFLAGS = "+frag_keyframe+empty_moov+default_base_moof"
+
+@dataclass
+class FragmentedMP4:
+    """What append_fragments needs to know about a fragmented MP4."""
+    track_id: int
+    timescale: int
+    codec_config: bytes
+    fragments_start: int
+    mfra_offset: int
+    end_time: int # Decode time after the last sample
+    presentation_start: int # Composition time of the first sample
+    presentation_end: int # Composition time after the last sample
+    last_sequence: int
+    random_access: list
+    sample_count: int
+    ends_in_band: bool
+
+def drawtext_filter(initial_text):
+    """Returns the drawtext filter that burns the frame timestamp into the top-left corner."""
+    return f"drawtext=fontfile={FONT_FILE}:text={initial_text}:fontcolor=white:fontsize=24:box=1:boxcolor=black@0.5:boxborderw=5:x=15:y=15"
+
+def list_new_frames(last_processed_ts):
+    """
+    Returns the paths of the frames newer than last_processed_ts, oldest
+    first. Frames live in YYYY-MM subdirectories (or at the top level
+    before migration), so months before the last processed one are skipped.
+    """
+    if not os.path.isdir(FRAME_DIR):
+        return []
+
+    last_ts = last_processed_ts or ""
+    frames = []
+    with os.scandir(FRAME_DIR) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if entry.name >= last_ts[:7]:
+                    with os.scandir(entry.path) as month_entries:
+                        frames.extend(e for e in month_entries if e.name.endswith(".png"))
+            elif entry.name.endswith(".png"):
+                frames.append(entry)
+
+    # Frame names are their capture timestamps, so they sort chronologically
+    frames = sorted((e for e in frames if e.name[:-len(".png")] > last_ts), key=lambda e: e.name)
+    return [e.path for e in frames]
+
+def iter_boxes(f, start, end):
+    """Yields (offset, size, type, header_size) for the MP4 boxes between start and end."""
+    while start + 8 <= end:
+        f.seek(start)
+        size, box_type = struct.unpack(">I4s", f.read(8))
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - start
+        if size < header_size or start + size > end:
+            raise ValueError(f"Corrupt MP4 box at offset {start}")
+        yield start, size, box_type, header_size
+        start += size
+
+def find_box(f, start, end, path):
+    """Returns (offset, size, header_size) of the first box along a path like 'moov/mvex/trex', or None."""
+    first, _, rest = path.partition("/")
+    for offset, size, box_type, header_size in iter_boxes(f, start, end):
+        if box_type == first.encode():
+            if not rest:
+                return offset, size, header_size
+            return find_box(f, offset + header_size, offset + size, rest)
+    return None
+
+def read_full_box(f, box):
+    """Returns (version, flags, payload) of a full box found by find_box."""
+    if box is None:
+        raise ValueError("Missing MP4 box")
+    offset, size, header_size = box
+    f.seek(offset + header_size)
+    data = f.read(size - header_size)
+    return data[0], int.from_bytes(data[1:4], "big"), data[4:]
+
+def fragment_times(f, traf, default_duration):
+    """
+    Returns (duration, presentation_start, presentation_end) of the samples
+    in every trun of a traf, all relative to its base decode time. The
+    presentation times add the samples' composition offsets.
+    """
+    _, tfhd_flags, tfhd = read_full_box(f, find_box(f, traf[0] + traf[2], traf[0] + traf[1], "tfhd"))
+    if tfhd_flags & 0x08:
+        pos = 4 + (8 if tfhd_flags & 0x01 else 0) + (4 if tfhd_flags & 0x02 else 0)
+        default_duration = struct.unpack_from(">I", tfhd, pos)[0]
+
+    total = presentation_end = 0
+    presentation_start = None
+    for offset, size, box_type, header_size in list(iter_boxes(f, traf[0] + traf[2], traf[0] + traf[1])):
+        if box_type != b"trun":
+            continue
+        version, flags, trun = read_full_box(f, (offset, size, header_size))
+        sample_count = struct.unpack_from(">I", trun, 0)[0]
+        pos = 4 + (4 if flags & 0x01 else 0) + (4 if flags & 0x04 else 0)
+        stride = 4 * bin(flags & 0xF00).count("1")
+        offset_pos = 4 * bin(flags & 0x700).count("1")
+        for i in range(sample_count):
+            sample = pos + i * stride
+            duration = struct.unpack_from(">I", trun, sample)[0] if flags & 0x100 else default_duration
+            composition_offset = 0
+            if flags & 0x800:
+                composition_offset = struct.unpack_from(">i" if version else ">I", trun, sample + offset_pos)[0]
+            if presentation_start is None or total + composition_offset < presentation_start:
+                presentation_start = total + composition_offset
+            presentation_end = max(presentation_end, total + composition_offset + duration)
+            total += duration
+    return total, presentation_start or 0, presentation_end
+
+def fragment_sample_count(f, moof):
+    """Counts the samples in every trun of a moof."""
+    offset, size, _, header_size = moof
+    count = 0
+    for traf, traf_size, box_type, traf_header in list(iter_boxes(f, offset + header_size, offset + size)):
+        if box_type != b"traf":
+            continue
+        for trun, trun_size, child_type, trun_header in list(iter_boxes(f, traf + traf_header, traf + traf_size)):
+            if child_type == b"trun":
+                f.seek(trun + trun_header + 4)
+                count += struct.unpack(">I", f.read(4))[0]
+    return count
+
+def read_fragmented_mp4(path):
+    """
+    Reads the layout of a single-track fragmented MP4 as written with
+    FRAGMENT_MOVFLAGS. Returns None for anything else, such as a master
+    written before the switch to fragments.
+    """
+    with open(path, "rb") as f:
+        top = list(iter_boxes(f, 0, os.fstat(f.fileno()).st_size))
+        types = [box_type for _, _, box_type, _ in top]
+        if types[:2] != [b"ftyp", b"moov"] or types[-1] != b"mfra":
+            return None
+        if any(box_type not in (b"moof", b"mdat") for box_type in types[2:-1]):
+            return None
+        moov, mfra = top[1], top[-1]
+        moov_end = moov[0] + moov[1]
+        if find_box(f, moov[0] + moov[3], moov_end, "mvex") is None or b"moof" not in types:
+            return None
+        if sum(1 for box in iter_boxes(f, moov[0] + moov[3], moov_end) if box[2] == b"trak") != 1:
+            return None
+
+        version, _, mdhd = read_full_box(f, find_box(f, 0, moov_end, "moov/trak/mdia/mdhd"))
+        timescale = struct.unpack_from(">I", mdhd, 16 if version == 1 else 8)[0]
+        # The sample entry's type and decoder config (avcC: the SPS and PPS).
+        # Its child boxes follow the 78 bytes of visual sample entry fields.
+        stsd = find_box(f, 0, moov_end, "moov/trak/mdia/minf/stbl/stsd")
+        if stsd is None:
+            raise ValueError("Missing MP4 box")
+        entry, entry_size, entry_type, entry_header = next(iter_boxes(f, stsd[0] + stsd[2] + 8, stsd[0] + stsd[1]))
+        config = find_box(f, entry + entry_header + 78, entry + entry_size, "avcC")
+        if config is None:
+            return None
+        f.seek(config[0])
+        codec_config = entry_type + f.read(config[1])
+        _, _, trex = read_full_box(f, find_box(f, 0, moov_end, "moov/mvex/trex"))
+        default_duration = struct.unpack_from(">I", trex, 8)[0]
+
+        # The master ends where its last fragment's samples end
+        last_moof = next(box for box in reversed(top) if box[2] == b"moof")
+        moof_start, moof_end = last_moof[0] + last_moof[3], last_moof[0] + last_moof[1]
+        _, _, mfhd = read_full_box(f, find_box(f, moof_start, moof_end, "mfhd"))
+        traf = find_box(f, moof_start, moof_end, "traf")
+        if traf is None:
+            raise ValueError(f"Fragment at offset {last_moof[0]} has no traf")
+        version, _, tfdt = read_full_box(f, find_box(f, traf[0] + traf[2], traf[0] + traf[1], "tfdt"))
+        base_time = struct.unpack_from(">Q" if version == 1 else ">I", tfdt)[0]
+        duration, _, presentation_end = fragment_times(f, traf, default_duration)
+        # B-frames delay the first frame's composition time past its decode
+        # time; there is no edit list in a fragmented file to hide that
+        first_moof = next(box for box in top if box[2] == b"moof")
+        first_traf = find_box(f, first_moof[0] + first_moof[3], first_moof[0] + first_moof[1], "traf")
+        if first_traf is None:
+            raise ValueError(f"Fragment at offset {first_moof[0]} has no traf")
+        version, _, first_tfdt = read_full_box(f, find_box(f, first_traf[0] + first_traf[2], first_traf[0] + first_traf[1], "tfdt"))
+        presentation_start = struct.unpack_from(">Q" if version == 1 else ">I", first_tfdt)[0]
+        presentation_start += fragment_times(f, first_traf, default_duration)[1]
+        # An SPS at the start of the last fragment's keyframe overrides the
+        # avcC for everything decoded after it
+        ends_in_band = False
+        _, trun_flags, trun = read_full_box(f, find_box(f, traf[0] + traf[2], traf[0] + traf[1], "trun"))
+        if trun_flags & 0x001 and struct.unpack_from(">I", trun, 0)[0]:
+            f.seek(last_moof[0] + struct.unpack_from(">i", trun, 4)[0] + parse_avcc(codec_config)[0])
+            nal_header = f.read(1)
+            ends_in_band = bool(nal_header) and nal_header[0] & 0x1F == 7
+
+        version, _, tfra = read_full_box(f, find_box(f, mfra[0] + mfra[3], mfra[0] + mfra[1], "tfra"))
+        track_id, lengths, count = struct.unpack_from(">III", tfra)
+        time_format = ">QQ" if version == 1 else ">II"
+        number_sizes = ((lengths >> 4 & 3) + 1, (lengths >> 2 & 3) + 1, (lengths & 3) + 1)
+        random_access, pos = [], 12
+        for _ in range(count):
+            time, moof_offset = struct.unpack_from(time_format, tfra, pos)
+            pos += struct.calcsize(time_format)
+            numbers = []
+            for number_size in number_sizes:
+                numbers.append(int.from_bytes(tfra[pos:pos + number_size], "big"))
+                pos += number_size
+            random_access.append((time, moof_offset, *numbers))
+
+        return FragmentedMP4(
+            track_id=track_id,
+            timescale=timescale,
+            codec_config=codec_config,
+            fragments_start=moov_end,
+            mfra_offset=mfra[0],
+            end_time=base_time + duration,
+            presentation_end=base_time + presentation_end,
+            presentation_start=presentation_start,
+            last_sequence=struct.unpack_from(">I", mfhd)[0],
+            random_access=random_access,
+            sample_count=sum(fragment_sample_count(f, box) for box in top if box[2] == b"moof"),
+            ends_in_band=ends_in_band,
+        )
+
+def shift_fragments(fragments, time_offset, sequence_offset):
+    """Shifts the decode times and sequence numbers of the moof boxes in a bytearray in place."""
+    f = io.BytesIO(fragments)
+    for offset, size, box_type, header_size in list(iter_boxes(f, 0, len(fragments))):
+        if box_type != b"moof":
+            continue
+        for child, child_size, child_type, child_header in list(iter_boxes(f, offset + header_size, offset + size)):
+            if child_type == b"mfhd":
+                pos = child + child_header + 4
+                struct.pack_into(">I", fragments, pos, struct.unpack_from(">I", fragments, pos)[0] + sequence_offset)
+            elif child_type == b"traf":
+                tfdt = find_box(f, child + child_header, child + child_size, "tfdt")
+                if tfdt is None:
+                    raise ValueError(f"Fragment at offset {offset} has no tfdt")
+                pos = tfdt[0] + tfdt[2] + 4
+                time_format = ">Q" if fragments[tfdt[0] + tfdt[2]] == 1 else ">I"
+                struct.pack_into(time_format, fragments, pos, struct.unpack_from(time_format, fragments, pos)[0] + time_offset)
+
+def build_mfra(track_id, random_access):
+    """Builds an mfra box holding a single tfra with the given random access entries."""
+    tfra_body = struct.pack(">BxxxIII", 1, track_id, 0x3F, len(random_access))
+    tfra_body += b"".join(struct.pack(">QQIII", *entry) for entry in random_access)
+    tfra = struct.pack(">I4s", 8 + len(tfra_body), b"tfra") + tfra_body
+    mfra_size = 8 + len(tfra) + 16
+    return struct.pack(">I4s", mfra_size, b"mfra") + tfra + struct.pack(">I4sII", 16, b"mfro", 0, mfra_size)
+
+def sps_decoding_fields(sps):
+    """
+    Returns the bits of an H.264 SPS that decoding depends on: everything
+    before the VUI, which only carries display hints such as colour and
+    timing information. An SPS with scaling lists is returned whole.
+    """
+    # Drop the emulation prevention bytes and the NAL header
+    rbsp = sps.replace(b"\x00\x00\x03", b"\x00\x00")[1:]
+    bits = "".join(f"{byte:08b}" for byte in rbsp)
+    pos = 24 # profile_idc, constraint flags and level_idc
+
+    def read_bits(count):
+        nonlocal pos
+        pos += count
+        return int(bits[pos - count:pos], 2)
+
+    def read_golomb():
+        nonlocal pos
+        zeros = bits.index("1", pos) - pos
+        pos += zeros
+        return read_bits(zeros + 1) - 1
+
+    read_golomb() # seq_parameter_set_id
+    if rbsp[0] in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        if read_golomb() == 3: # chroma_format_idc
+            read_bits(1)
+        read_golomb()
+        read_golomb()
+        read_bits(1)
+        if read_bits(1): # seq_scaling_matrix_present_flag
+            return bits
+    read_golomb() # log2_max_frame_num_minus4
+    poc_type = read_golomb()
+    if poc_type == 0:
+        read_golomb()
+    elif poc_type == 1:
+        read_bits(1)
+        read_golomb()
+        read_golomb()
+        for _ in range(read_golomb()):
+            read_golomb()
+    read_golomb() # max_num_ref_frames
+    read_bits(1)
+    read_golomb() # pic_width_in_mbs_minus1
+    read_golomb()
+    if not read_bits(1): # frame_mbs_only_flag
+        read_bits(1)
+    read_bits(1)
+    if read_bits(1): # frame_cropping_flag
+        for _ in range(4):
+            read_golomb()
+    return bits[:pos]
+
+def parse_avcc(codec_config):
+    """Returns (NAL length size, SPS list, PPS list) of a sample entry's avcC."""
+    avcc = codec_config[12:]
+    length_size = (avcc[4] & 3) + 1
+    parameter_sets, pos = [], 5
+    for _ in range(2): # the SPS list, then the PPS list
+        count = avcc[pos] & (0x1F if not parameter_sets else 0xFF)
+        pos += 1
+        nals = []
+        for _ in range(count):
+            size = struct.unpack_from(">H", avcc, pos)[0]
+            nals.append(avcc[pos + 2:pos + 2 + size])
+            pos += 2 + size
+        parameter_sets.append(nals)
+    return length_size, *parameter_sets
+
+def decoding_config(codec_config):
+    """
+    Returns the parts of a sample entry's avcC that decoding depends on:
+    the NAL length size, the SPS up to its VUI, and the PPS.
+    """
+    length_size, sps, pps = parse_avcc(codec_config)
+    return codec_config[:4], length_size, [sps_decoding_fields(nal) for nal in sps], pps
+
+def insert_parameter_sets(fragments, codec_config):
+    """
+    Writes the SPS and PPS of codec_config in-band at the start of every
+    fragment's first sample, the keyframe it starts with. Returns the new
+    fragments and a map from old to new moof offsets, or None unless each
+    fragment is a moof with one traf and trun followed by its mdat, as
+    written with FRAGMENT_MOVFLAGS.
+    """
+    length_size, sps, pps = parse_avcc(codec_config)
+    parameter_sets = b"".join(len(nal).to_bytes(length_size, "big") + nal for nal in sps + pps)
+
+    f = io.BytesIO(fragments)
+    boxes = list(iter_boxes(f, 0, len(fragments)))
+    if len(boxes) % 2 or any(box[2] != box_type for box, box_type in zip(boxes, itertools.cycle((b"moof", b"mdat")))):
+        return None
+
+    result = bytearray()
+    moof_offsets = {}
+    for (moof, moof_size, _, moof_header), (mdat, mdat_size, _, mdat_header) in zip(boxes[::2], boxes[1::2]):
+        trafs = [box for box in iter_boxes(f, moof + moof_header, moof + moof_size) if box[2] == b"traf"]
+        if len(trafs) != 1:
+            return None
+        traf, traf_size, _, traf_header = trafs[0]
+        truns = [box for box in iter_boxes(f, traf + traf_header, traf + traf_size) if box[2] == b"trun"]
+        _, tfhd_flags, _ = read_full_box(f, find_box(f, traf + traf_header, traf + traf_size, "tfhd"))
+        if len(truns) != 1 or not tfhd_flags & 0x20000: # default-base-is-moof
+            return None
+
+        # The first sample has to start the mdat payload and have its own size
+        trun = truns[0][0] + truns[0][3]
+        trun_flags = int.from_bytes(fragments[trun + 1:trun + 4], "big")
+        if trun_flags & 0x201 != 0x201:
+            return None
+        if struct.unpack_from(">i", fragments, trun + 8)[0] != moof_size + mdat_header:
+            return None
+        size_pos = trun + 12 + (4 if trun_flags & 0x004 else 0) + (4 if trun_flags & 0x100 else 0)
+
+        moof_offsets[moof] = len(result)
+        new_moof = bytearray(fragments[moof:moof + moof_size])
+        struct.pack_into(">I", new_moof, size_pos - moof, struct.unpack_from(">I", fragments, size_pos)[0] + len(parameter_sets))
+        result += new_moof
+        if mdat_header == 16:
+            result += struct.pack(">I4sQ", 1, b"mdat", mdat_size + len(parameter_sets))
+        else:
+            result += struct.pack(">I4s", mdat_size + len(parameter_sets), b"mdat")
+        result += parameter_sets
+        result += fragments[mdat + mdat_header:mdat + mdat_size]
+    return result, moof_offsets
+
+def append_fragments(master_path, chunk_path):
+    """
+    Appends the fragments of chunk_path to master_path in place, continuing
+    the master's timeline and sequence numbers, and rewrites the
+    trailing mfra index to cover both. Returns the master's old mfra offset
+    and bytes for undo_append, or None if the files cannot be joined
+    byte-wise and need a full remux instead.
+    """
+    master = read_fragmented_mp4(master_path)
+    chunk = read_fragmented_mp4(chunk_path)
+    if master is None:
+        print(f"{master_path} is not a fragmented MP4 yet, so it will be remuxed once.")
+        return None
+    if chunk is None:
+        print(f"Warning: {chunk_path} is not a fragmented MP4, falling back to a full remux.")
+        return None
+    if master.timescale != chunk.timescale:
+        print(f"Warning: Timescale mismatch (master {master.timescale}, chunk {chunk.timescale}), falling back to a full remux.")
+        return None
+
+    # Start presenting the chunk where the master's presentation ends. Its
+    # decode times must not overlap the master's, though, so after a chunk
+    # too short for B-frames the master's last frame is held a little longer.
+    time_offset = max(master.presentation_end - chunk.presentation_start, master.end_time)
+
+    with open(chunk_path, "rb") as f:
+        f.seek(chunk.fragments_start)
+        fragments = bytearray(f.read(chunk.mfra_offset - chunk.fragments_start))
+
+    # The master keeps its own SPS and PPS. A chunk encoded against ones that
+    # differ in what decoding depends on (another frame size or preset), or
+    # following fragments that switched to in-band ones, carries its own
+    # in-band before each keyframe, as the concat remux does.
+    master_length_size = parse_avcc(master.codec_config)[0]
+    if master_length_size != parse_avcc(chunk.codec_config)[0]:
+        print("Warning: NAL length size mismatch, falling back to a full remux.")
+        return None
+    moof_offsets = {}
+    same_config = decoding_config(master.codec_config) == decoding_config(chunk.codec_config)
+    if same_config and master.codec_config != chunk.codec_config:
+        print("Note: The chunk's codec config differs from the master's only in its VUI; keeping the master's.")
+    if not same_config or master.ends_in_band:
+        inserted = insert_parameter_sets(fragments, chunk.codec_config)
+        if inserted is None:
+            print("Warning: Unexpected fragment layout for in-band SPS/PPS, falling back to a full remux.")
+            return None
+        print("Note: Writing the chunk's SPS/PPS in-band before each keyframe.")
+        fragments, moof_offsets = inserted
+    shift_fragments(fragments, time_offset, master.last_sequence)
+
+    random_access = master.random_access
+    for time, moof_offset, *numbers in chunk.random_access:
+        moof_offset -= chunk.fragments_start
+        moof_offset = master.mfra_offset + moof_offsets.get(moof_offset, moof_offset)
+        random_access.append((time + time_offset, moof_offset, *numbers))
+
+    with open(master_path, "r+b") as f:
+        f.seek(master.mfra_offset)
+        old_mfra = f.read()
+        f.seek(master.mfra_offset)
+        f.write(fragments)
+        f.write(build_mfra(master.track_id, random_access))
+        f.truncate()
+    return master.mfra_offset, old_mfra
+
+def undo_append(master_path, mfra_offset, old_mfra):
+    """Restores a master video to how it was before append_fragments."""
+    with open(master_path, "r+b") as f:
+        f.seek(mfra_offset)
+        f.write(old_mfra)
+        f.truncate()
+
+def probe_video(path):
+    """
+    Returns (frames, duration) of the video. A fragmented MP4 is measured
+    from its moof headers alone, without reading the media; anything else
+    is probed by ffprobe counting packets.
+    """
+    fragmented = read_fragmented_mp4(path)
+    if fragmented:
+        return fragmented.sample_count, (fragmented.presentation_end - fragmented.presentation_start) / fragmented.timescale
+
+    probe_command = [
+        "ffprobe", "-v", "error", "-count_packets", "-print_format", "json",
+        "-show_streams", path
+    ]
+    result = subprocess.run(probe_command, check=True, capture_output=True, text=True)
+    stream = json.loads(result.stdout)["streams"][0]
+    return int(stream.get("nb_read_packets", 0)), float(stream.get("duration", 0.0))
+
+def run_ffmpeg(command, **kwargs):
+    """
+    Runs ffmpeg like subprocess.run(check=True), but keeps only the last
+    STDERR_TAIL_LINES lines of its stderr for the CalledProcessError rather
+    than buffering the whole log.
+    """
+    with subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, **kwargs) as process:
+        tail = collections.deque(process.stderr, maxlen=STDERR_TAIL_LINES)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command, stderr="".join(tail))
+
+def verify_tail(path, seconds):
+    """Decodes the last `seconds` of a video, failing on the first error."""
+    command = [
+        "ffmpeg", "-v", "error", "-xerror", "-sseof", f"-{seconds}", "-i", path,
+        "-f", "null", "-"
+    ]
+    run_ffmpeg(command)
+
+def link_frame(src, dst):
+    """
+    Hard-links a frame into TEMP_DIR. Unlike symlinks, hard links need no
+    privileges on Windows; a copy is made where linking is not supported.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def clear_temp_dir():
+    """Removes the files and frame links in TEMP_DIR, keeping the directory."""
+    with os.scandir(TEMP_DIR) as entries:
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                os.remove(entry.path)
 
 def main():
     """
-    Finds PNG frames, stamps them, creates a video chunk, appends it to the
+    Finds PNG frames, renders them into a timestamped video chunk, appends it to the
     master video, verifies the result, and cleans up.
     """
     print("--- Python script starting: Finding frames ---")
@@ -31,93 +550,61 @@ def main():
         except (json.JSONDecodeError, FileNotFoundError):
             print("Could not read state file, will process all frames.")
 
-    all_frames = sorted(glob.glob(os.path.join(FRAME_DIR, "**", "*.png"), recursive=True))
-    if last_processed_ts:
-        # Filter for frames that are newer than the last processed timestamp
-        files = [f for f in all_frames if os.path.splitext(os.path.basename(f))[0] > last_processed_ts]
-    else:
-        files = all_frames
+    files = list_new_frames(last_processed_ts)
 
     if not files:
         print("No new frames found. Exiting.")
         return
 
-    # --- Create a clean temporary directory ---
-    if os.path.exists(TEMP_DIR):
-        shutil.rmtree(TEMP_DIR)
-    os.makedirs(TEMP_DIR)
-    print(f"Created temporary directory: {TEMP_DIR}")
+    # --- Prepare the temporary directory ---
+    # It only holds frame links and the stamp commands. Links left by a
+    # failed run are removed, as image2 would read on past this run's frames.
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    clear_temp_dir()
+    print(f"Using temporary directory: {TEMP_DIR}")
 
     # --- Process all available frames ---
     files_to_process = files
     print(f"\nProcessing {len(files_to_process)} files...")
 
-    for input_path in files_to_process:
-        filename = os.path.basename(input_path)
-        raw_ts = os.path.splitext(filename)[0]
-        output_path = os.path.join(TEMP_DIR, filename)
-
-        # The timestamp from the filename is already in the correct format
-        timestamp = raw_ts
-
-        # Write timestamp to a temporary file to avoid shell escaping issues
-        timestamp_file_path = os.path.join(TEMP_DIR, f"{raw_ts}.txt")
-        with open(timestamp_file_path, "w") as f:
-            f.write(timestamp)
-
-        print(f"  - Stamping {filename}...")
-
-        # Build the ffmpeg command as a list of arguments
-        command = [
-            "ffmpeg", "-y", "-i", input_path,
-            "-vf", f"drawtext=fontfile=/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf:textfile={timestamp_file_path}:fontcolor=white:fontsize=24:box=1:boxcolor=black@0.5:boxborderw=5:x=15:y=15",
-            "-frames:v", "1",
-            output_path
-        ]
-
-        # Run the command and verify
-        try:
-            subprocess.run(command, check=True, capture_output=True, text=True)
-            if not os.path.exists(output_path):
-                raise RuntimeError(f"ffmpeg command ran but output file was not created: {output_path}")
-        except subprocess.CalledProcessError as e:
-            print(f"ERROR: ffmpeg failed for {filename}.")
-            print(f"  - Stderr: {e.stderr}")
-            raise # Stop the script if any command fails
-
-    print(f"\n--- Stamping complete. Rendering video chunk: {CHUNK_FILENAME} ---")
-
-    # --- Create video from stamped frames ---
-    stamped_files = sorted(glob.glob(os.path.join(TEMP_DIR, "*.png")))
-    concat_list_path = os.path.join(TEMP_DIR, "concat_list.txt")
-
-    with open(concat_list_path, "w") as f:
-        for sf in stamped_files:
-            # The paths in the concat list must be relative to the concat file's location.
-            filename = os.path.basename(sf)
-            f.write(f"file '{filename}'\n")
-            # For the concat demuxer, we must specify the duration of each image.
-            # 1/8 fps = 0.125 seconds.
-            f.write("duration 0.125\n")
+    print(f"\n--- Rendering video chunk: {CHUNK_FILENAME} ---")
+
+    # --- Link the frames into a sequence and write the stamp commands ---
+    # Frames are read straight from FRAME_DIR and stamped while encoding:
+    # sendcmd swaps the drawtext text at each frame's timestamp, so no
+    # intermediate stamped PNGs are written. The timestamp from the filename
+    # is already in the correct format. image2 decodes the linked sequence
+    # about twice as fast as the concat demuxer, which reopens a demuxer and
+    # decoder for every file.
+    with open(os.path.join(TEMP_DIR, STAMP_COMMANDS), "w") as c:
+        for i, input_path in enumerate(files_to_process):
+            link_frame(input_path, os.path.join(TEMP_DIR, FRAME_PATTERN % i))
+            raw_ts = os.path.splitext(os.path.basename(input_path))[0]
+            c.write(f"{i * FRAME_DURATION:.3f} drawtext reinit text={raw_ts};\n")
 
     # Build the ffmpeg command to create the video chunk
     command = [
         "ffmpeg", "-y",
         # --- INPUT OPTIONS ---
-        "-f", "concat",
-        "-safe", "0",
-        "-i", "concat_list.txt", # Now relative to the new working directory
+        # One frame every 1/8 s, so every stamp command lands on its own frame
+        "-framerate", "8",
+        "-i", FRAME_PATTERN, # Relative to the working directory, TEMP_DIR
         # --- OUTPUT OPTIONS ---
-        # Dynamically crop the height to the nearest even number for x264 compatibility
-        "-vf", "crop=iw:floor(in_h/2)*2",
-        "-c:v", "libx264", "-r", "8", "-pix_fmt", "yuv420p",
-        "-crf", "28", "-tune", "stillimage",
+        # Stamp the frames, then dynamically crop the height to the nearest
+        # even number for x264 compatibility
+        "-vf", ",".join([
+            f"sendcmd=f={STAMP_COMMANDS}",
+            drawtext_filter(os.path.splitext(os.path.basename(files_to_process[0]))[0]),
+            "crop=iw:floor(in_h/2)*2",
+        ]),
+        "-r", "8", "-pix_fmt", "yuv420p", *X264_ARGS,
+        "-movflags", FRAGMENT_MOVFLAGS,
         f"../{CHUNK_FILENAME}" # The output path is now relative to the temp_frames dir
     ]
 
     try:
         # Run the command with the working directory set to TEMP_DIR
-        subprocess.run(command, check=True, capture_output=True, text=True, cwd=TEMP_DIR)
+        run_ffmpeg(command, cwd=TEMP_DIR)
         if not os.path.exists(CHUNK_FILENAME):
             raise RuntimeError(f"ffmpeg command ran but output file was not created: {CHUNK_FILENAME}")
     except subprocess.CalledProcessError as e:
@@ -130,17 +617,12 @@ def main():
     expected_duration = 0.0
 
     # Get properties of the old master video, if it exists
-    if os.path.exists(MASTER_FILENAME):
+    master_exists = os.path.exists(MASTER_FILENAME)
+    if master_exists:
         try:
-            probe_command = [
-                "ffprobe", "-v", "error", "-print_format", "json",
-                "-show_streams", MASTER_FILENAME
-            ]
-            result = subprocess.run(probe_command, check=True, capture_output=True, text=True)
-            video_info = json.loads(result.stdout)
-            stream = video_info["streams"][0]
-            expected_frames += int(stream.get("nb_frames", 0))
-            expected_duration += float(stream.get("duration", 0.0))
+            master_frames, master_duration = probe_video(MASTER_FILENAME)
+            expected_frames += master_frames
+            expected_duration += master_duration
         except Exception as e:
             print(f"Warning: Could not probe existing master video. Will not check duration. Error: {e}")
             # In case of error, disable the check for this run
@@ -156,25 +638,37 @@ def main():
     # --- Stitch the new chunk to the master video ---
     temp_master = "temp_master.mp4"
     concat_list_path = "concat_list.txt"
+    appended = None
+    command = None
 
-    if os.path.exists(MASTER_FILENAME):
+    if master_exists:
+        try:
+            appended = append_fragments(MASTER_FILENAME, CHUNK_FILENAME)
+        except (ValueError, IndexError, struct.error) as e:
+            print(f"Warning: Could not read the videos' fragments, falling back to a full remux. Error: {e}")
+
+    if appended:
+        # Only the new fragments and the index were written; verify in place
+        print(f"Appended the new chunk's fragments to {MASTER_FILENAME} in place.")
+        temp_master = MASTER_FILENAME
+    elif master_exists:
         print(f"Found existing master video. Preparing to append.")
         with open(concat_list_path, "w") as f:
             f.write(f"file '{MASTER_FILENAME}'\n")
             f.write(f"file '{CHUNK_FILENAME}'\n")
         
+        # Remuxing also converts a master written before the switch to fragments
         command = [
             "ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", concat_list_path,
-            "-c", "copy", temp_master
+            "-c", "copy", "-movflags", FRAGMENT_MOVFLAGS, temp_master
         ]
     else:
         print(f"No master video found. The new chunk will become the master.")
-        shutil.move(CHUNK_FILENAME, temp_master)
-        command = None # No command to run
+        os.replace(CHUNK_FILENAME, temp_master)
 
     if command:
         try:
-            subprocess.run(command, check=True, capture_output=True, text=True)
+            run_ffmpeg(command)
         except subprocess.CalledProcessError as e:
             print(f"ERROR: ffmpeg failed while stitching videos.")
             print(f"  - Stderr: {e.stderr}")
@@ -184,15 +678,10 @@ def main():
     print("\n--- Verifying and cleaning up ---")
     try:
         # Observe the actual properties of the newly created video
-        probe_command = [
-            "ffprobe", "-v", "error", "-print_format", "json",
-            "-show_streams", temp_master
-        ]
-        result = subprocess.run(probe_command, check=True, capture_output=True, text=True)
-        video_info = json.loads(result.stdout)
-        stream = video_info["streams"][0]
-        actual_frames = int(stream.get("nb_frames", 0))
-        actual_duration = float(stream.get("duration", 0.0))
+        actual_frames, actual_duration = probe_video(temp_master)
+        # Only the new chunk can be broken, so decode just the tail that
+        # holds it rather than the whole history
+        verify_tail(temp_master, len(files_to_process) * FRAME_DURATION + 5)
 
         print(f"Verification: Expected ~{expected_frames} frames, got {actual_frames}.")
         print(f"Verification: Expected ~{expected_duration:.2f}s duration, got {actual_duration:.2f}s.")
@@ -202,23 +691,30 @@ def main():
             raise RuntimeError(f"Verification failed: Properties do not match prediction.")
 
         print("SUCCESS: New master video is valid and matches predictions.")
-        shutil.move(temp_master, MASTER_FILENAME)
+        if temp_master != MASTER_FILENAME:
+            os.replace(temp_master, MASTER_FILENAME)
         print(f"Updated {MASTER_FILENAME}.")
 
-        # On success, clean up everything
-        shutil.rmtree(TEMP_DIR)
-        if os.path.exists(CHUNK_FILENAME): os.remove(CHUNK_FILENAME)
-        if os.path.exists(concat_list_path): os.remove(concat_list_path)
+        # On success, clean up everything but TEMP_DIR itself, which is reused
+        clear_temp_dir()
+        for leftover in (CHUNK_FILENAME, concat_list_path):
+            try:
+                os.remove(leftover)
+            except FileNotFoundError:
+                pass
         for f in files_to_process: # Delete the original source frames
             os.remove(f)
         print("Cleaned up temporary files and original frames.")
 
-    except (subprocess.CalledProcessError, FileNotFoundError, RuntimeError) as e:
+    except (subprocess.CalledProcessError, FileNotFoundError, RuntimeError, ValueError, struct.error) as e:
         print("CRITICAL FAILURE: New master video is corrupt. Aborting to protect old video and frames.")
         print(f"Error details: {e}")
+        if appended:
+            undo_append(MASTER_FILENAME, *appended)
+            print(f"Restored {MASTER_FILENAME} to its previous state.")
         raise # Re-raise the exception to fail the workflow
 
     print(f"\n--- Python script finished successfully. ---")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()